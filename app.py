@@ -1,30 +1,55 @@
 # app.py
 import os
+import time
 import asyncio
 import logging
 from pathlib import Path
-from typing import Dict, List, Tuple
+
+# orjson (C-реализация) заметно быстрее стандартного json на телах
+# Telegram/Gemini запросов; без него откатываемся на stdlib
+try:
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+
+    _json_dumps = json.dumps
+    _json_loads = json.loads
 
 from dotenv import load_dotenv
+import aiohttp
 from aiohttp import web
 
+# uvloop: C-реализация event loop (~2-4x меньше накладных расходов на I/O);
+# на Windows его нет, поэтому импорт опциональный
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    uvloop = None
+
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from google import genai
-
-from storage import init_db, upsert_lead, count_leads, Lead
+from storage import init_db, upsert_lead, count_leads, Lead, mem_append, mem_history, mem_clear
 
 logging.basicConfig(level=logging.INFO)
 
 BASE_DIR = Path(__file__).resolve().parent
 
-# Optional .env for local runs
+# Optional .env for local runs; если окружение уже задано (прод/перезапуск),
+# .env не перечитываем вообще
 env_path = BASE_DIR / ".env"
-if env_path.exists() and env_path.stat().st_size > 0:
+if not os.getenv("BOT_TOKEN") and env_path.exists() and env_path.stat().st_size > 0:
     load_dotenv(env_path)
 
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
@@ -37,10 +62,18 @@ TIMEZONE = (os.getenv("TIMEZONE") or "Asia/Aqtobe").strip()
 # Gemini model: fast + cheap, good for чат-бота
 GEMINI_MODEL = (os.getenv("GEMINI_MODEL") or "gemini-2.5-flash").strip()
 
+# Webhook mode (если задан PUBLIC_URL) — быстрее polling: Telegram сам шлёт
+# апдейты в наш aiohttp-сервер, без цикла getUpdates
+PUBLIC_URL = (os.getenv("PUBLIC_URL") or "").strip().rstrip("/")
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip()
+WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET}" if WEBHOOK_SECRET else "/webhook"
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is empty. Set it in environment variables or .env")
 
-bot = Bot(BOT_TOKEN)
+# одна aiohttp-сессия на весь процесс для Telegram API (keep-alive, без
+# повторных TLS-рукопожатий)
+bot = Bot(BOT_TOKEN, session=AiohttpSession(json_loads=_json_loads, json_dumps=_json_dumps))
 dp = Dispatcher()
 
 # --------- System prompt (agent instruction) ----------
@@ -66,73 +99,232 @@ def load_agent_prompt() -> str:
 AGENT_PROMPT = load_agent_prompt()
 
 # --------- Tiny memory (per user) ----------
-# хранит последние N сообщений (для контекста ИИ)
-MEM: Dict[int, List[Tuple[str, str]]] = {}
+# последние N сообщений для контекста ИИ лежат в SQLite (таблица chat_mem):
+# память процесса не растёт с числом пользователей и переживает рестарты
 MEM_MAX = 10
 
 def mem_add(user_id: int, role: str, text: str) -> None:
-    MEM.setdefault(user_id, [])
-    MEM[user_id].append((role, text))
-    if len(MEM[user_id]) > MEM_MAX:
-        MEM[user_id] = MEM[user_id][-MEM_MAX:]
+    mem_append(user_id, role, text, MEM_MAX)
 
 def mem_pack(user_id: int) -> str:
-    items = MEM.get(user_id, [])
     out = []
-    for role, txt in items:
+    for role, txt in mem_history(user_id):
         out.append(f"{role.upper()}: {txt}")
     return "\n".join(out).strip()
 
 # --------- Gemini client ----------
-gemini_client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
+GEMINI_URL = (
+    "https://generativelanguage.googleapis.com/v1beta/models/"
+    f"{GEMINI_MODEL}:generateContent"
+)
+GEMINI_CACHE_URL = "https://generativelanguage.googleapis.com/v1beta/cachedContents"
+GEMINI_CACHE_TTL = 3600  # сек
+
+# одна долгоживущая сессия для Gemini: TLS/DNS/keep-alive амортизируются
+# между запросами, а не платятся на каждом вызове
+_http: aiohttp.ClientSession | None = None
+
+def get_http() -> aiohttp.ClientSession:
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(json_serialize=_json_dumps)
+    return _http
+
+# системный промпт кэшируем на стороне Gemini (cachedContents): каждый вызов
+# ссылается на кэш по имени и не платит его токены заново
+_cache_name: str | None = None
+_cache_expires = 0.0
+_cache_retry_after = 300  # сек: отказ может быть постоянным (минимум токенов)
+_cache_lock = asyncio.Lock()
+
+async def _get_prompt_cache() -> str | None:
+    global _cache_name, _cache_expires
+    # ретраим только по истечении срока: и успех, и отказ двигают
+    # _cache_expires, так что неудача не добавляет round-trip каждому вызову
+    if time.monotonic() < _cache_expires:
+        return _cache_name
+    async with _cache_lock:
+        now = time.monotonic()
+        if now < _cache_expires:  # другой таск уже успел
+            return _cache_name
+        try:
+            async with get_http().post(
+                GEMINI_CACHE_URL,
+                json={
+                    "model": f"models/{GEMINI_MODEL}",
+                    "systemInstruction": {"parts": [{"text": AGENT_PROMPT}]},
+                    "ttl": f"{GEMINI_CACHE_TTL}s",
+                },
+                headers={"x-goog-api-key": GEMINI_API_KEY},
+            ) as resp:
+                resp.raise_for_status()
+                data = await resp.json(loads=_json_loads)
+            _cache_name = data.get("name")
+            # пересоздаём чуть раньше, чем истечёт TTL
+            _cache_expires = now + GEMINI_CACHE_TTL - 60
+        except Exception:
+            logging.warning("Gemini prompt cache unavailable, sending prompt inline")
+            _cache_name = None
+            _cache_expires = now + _cache_retry_after
+        return _cache_name
 
 async def ask_gemini(user_id: int, user_text: str) -> str:
     """
-    Асинхронная обёртка (SDK синхронный -> в отдельный поток)
+    Запрос к Gemini по REST через общую aiohttp-сессию
     """
-    if not gemini_client:
+    if not GEMINI_API_KEY:
         return "ИИ сейчас не подключён (нет GEMINI_API_KEY). Но я могу помочь кнопками меню 🙂"
 
     # Контекст: system + краткая память
     history = mem_pack(user_id)
-    prompt = (
-        f"SYSTEM:\n{AGENT_PROMPT}\n\n"
-        f"CONTEXT (short chat history):\n{history}\n\n"
-        f"USER:\n{user_text}\n"
-    )
 
-    def _call() -> str:
-        resp = gemini_client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=prompt,
+    cache = await _get_prompt_cache()
+    if cache:
+        prompt = (
+            f"CONTEXT (short chat history):\n{history}\n\n"
+            f"USER:\n{user_text}\n"
+        )
+        body = {
+            "contents": [{"parts": [{"text": prompt}]}],
+            "cachedContent": cache,
+        }
+    else:
+        prompt = (
+            f"SYSTEM:\n{AGENT_PROMPT}\n\n"
+            f"CONTEXT (short chat history):\n{history}\n\n"
+            f"USER:\n{user_text}\n"
         )
-        return (resp.text or "").strip()
+        body = {"contents": [{"parts": [{"text": prompt}]}]}
 
     try:
-        return await asyncio.to_thread(_call)
+        async with get_http().post(
+            GEMINI_URL,
+            json=body,
+            headers={"x-goog-api-key": GEMINI_API_KEY},
+        ) as resp:
+            resp.raise_for_status()
+            data = await resp.json(loads=_json_loads)
+        parts = data["candidates"][0]["content"]["parts"]
+        return "".join(p.get("text", "") for p in parts).strip()
     except Exception:
         logging.exception("Gemini call failed")
         return "Упс, сейчас не получилось ответить через ИИ. Попробуй ещё раз через минуту 🙂"
 
-# --------- Keyboards ----------
-def main_menu() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📌 Записаться на пробный урок")],
-            [KeyboardButton(text="📚 Подобрать курс"), KeyboardButton(text="💬 Вопрос ИИ")],
-            [KeyboardButton(text="💰 Цена и пакеты"), KeyboardButton(text="🧪 Определить уровень")],
-        ],
-        resize_keyboard=True,
-    )
+# --------- Background tasks ----------
+# фоновые задачи держим в set, чтобы GC не собрал их на полпути
+_BG_TASKS: set = set()
 
-def age_menu() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Взрослый"), KeyboardButton(text="Подросток (13–17)")],
-            [KeyboardButton(text="Ребёнок (6–12)"), KeyboardButton(text="Не хочу говорить")],
-        ],
-        resize_keyboard=True,
-    )
+def spawn(coro) -> None:
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+
+# --------- Bounded AI dispatch ----------
+# медленный ответ Gemini не должен держать обработчик апдейта: задача уходит
+# в фон, семафор ограничивает число одновременных запросов к ИИ
+AI_SEM = asyncio.Semaphore(16)
+
+async def _ai_reply(m: Message, user_text: str) -> None:
+    async with AI_SEM:
+        answer = await ask_gemini(m.from_user.id, user_text)
+
+    # чуть-чуть защиты от пустого ответа
+    if not answer:
+        answer = "Я не смог(ла) сформулировать ответ. Спроси иначе или нажми «📚 Подобрать курс»."
+
+    mem_add(m.from_user.id, "assistant", answer)
+    try:
+        await m.answer(answer, reply_markup=MAIN_MENU)
+    except Exception:
+        # фоновая задача — сюда не доберётся error handler диспетчера
+        # (типичный случай: пользователь заблокировал бота)
+        logging.exception("Failed to send AI reply")
+
+def dispatch_ai(m: Message, user_text: str) -> None:
+    spawn(_ai_reply(m, user_text))
+
+async def _notify_admin(text: str) -> None:
+    try:
+        await bot.send_message(ADMIN_ID, text)
+    except Exception:
+        logging.exception("Failed to notify admin")
+
+# шаблон собран один раз; в обработчике остаётся только format_map
+ADMIN_TPL = (
+    "📥 НОВЫЙ ЛИД:\n"
+    "tg_id: {tg_id}\n"
+    "name: {name}\n"
+    "age: {age_group}\n"
+    "level: {level}\n"
+    "goal: {goal}\n"
+    "schedule: {schedule}\n"
+    "contact: {contact}"
+)
+
+
+# --------- Keyboards ----------
+# клавиатуры неизменны — строим их один раз при импорте, а не pydantic-модели
+# на каждый ответ
+MAIN_MENU = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📌 Записаться на пробный урок")],
+        [KeyboardButton(text="📚 Подобрать курс"), KeyboardButton(text="💬 Вопрос ИИ")],
+        [KeyboardButton(text="💰 Цена и пакеты"), KeyboardButton(text="🧪 Определить уровень")],
+    ],
+    resize_keyboard=True,
+)
+
+AGE_MENU = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Взрослый"), KeyboardButton(text="Подросток (13–17)")],
+        [KeyboardButton(text="Ребёнок (6–12)"), KeyboardButton(text="Не хочу говорить")],
+    ],
+    resize_keyboard=True,
+)
+
+# --------- Canned replies + keyword routing ----------
+PRICING_TEXT = (
+    "💰 Пример (замени на ваши реальные):\n"
+    "• Пробный урок: 30–45 минут\n"
+    "• Индивидуально: 2–3 раза в неделю\n"
+    "• Группа: 6–10 человек\n\n"
+    "Хочешь — подберу вариант под цель. Нажми «📚 Подобрать курс»."
+)
+
+LEVEL_TEXT = (
+    "Быстрая оценка уровня:\n"
+    "1) Сколько лет учишь английский?\n"
+    "2) Смотришь ли видео без субтитров?\n"
+    "3) Что сложнее: говорить или понимать?\n\n"
+    "Ответь 2–3 предложениями — и я скажу примерный уровень (A1–C1)."
+)
+
+# частые вопросы (цена/уровень) отвечаем готовым текстом без похода в Gemini.
+# pyahocorasick (если установлен) ищет все ключевые слова одним линейным
+# проходом по тексту; иначе — обычные `in`-сканы
+KEYWORDS = {
+    "price": ("цена", "цены", "стоимость", "сколько стоит", "прайс", "тариф", "пакет"),
+    "level": ("уровень", "уровня", "какой у меня", "a1", "b1", "b2", "ielts"),
+}
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+if ahocorasick is not None:
+    _KW_AUTOMATON = ahocorasick.Automaton()
+    for _tag, _words in KEYWORDS.items():
+        for _w in _words:
+            _KW_AUTOMATON.add_word(_w, _tag)
+    _KW_AUTOMATON.make_automaton()
+else:
+    _KW_AUTOMATON = None
+
+def match_keywords(text: str) -> set:
+    if _KW_AUTOMATON is not None:
+        return {tag for _, tag in _KW_AUTOMATON.iter(text)}
+    return {tag for tag, words in KEYWORDS.items() if any(w in text for w in words)}
 
 # --------- FSM ----------
 class Intake(StatesGroup):
@@ -155,146 +347,123 @@ async def start(m: Message, state: FSMContext):
         f"Привет! Я ИИ-ассистент школы **{SCHOOL_NAME}** 🙂\n"
         f"Помогу выбрать курс и записаться на пробный урок.\n\n"
         f"Выбери кнопку ниже 👇",
-        reply_markup=main_menu(),
+        reply_markup=MAIN_MENU,
         parse_mode="Markdown",
     )
 
-@dp.message(F.text == "📌 Записаться на пробный урок")
 async def trial(m: Message, state: FSMContext):
     mem_add(m.from_user.id, "user", m.text)
     await state.set_state(Intake.name)
     await m.answer("Супер. Как тебя зовут?")
 
-@dp.message(F.text == "📚 Подобрать курс")
 async def pick_course(m: Message, state: FSMContext):
     mem_add(m.from_user.id, "user", m.text)
     await state.set_state(Intake.goal)
     await m.answer("Для чего английский? (разговорный / работа / IELTS / переезд / универ)")
 
-@dp.message(F.text == "💰 Цена и пакеты")
 async def pricing(m: Message, state: FSMContext | None = None):
     mem_add(m.from_user.id, "user", m.text)
-    await m.answer(
-        "💰 Пример (замени на ваши реальные):\n"
-        "• Пробный урок: 30–45 минут\n"
-        "• Индивидуально: 2–3 раза в неделю\n"
-        "• Группа: 6–10 человек\n\n"
-        "Хочешь — подберу вариант под цель. Нажми «📚 Подобрать курс»."
-    )
+    await m.answer(PRICING_TEXT)
 
-@dp.message(F.text == "🧪 Определить уровень")
 async def level_test(m: Message, state: FSMContext | None = None):
     mem_add(m.from_user.id, "user", m.text)
-    await m.answer(
-        "Быстрая оценка уровня:\n"
-        "1) Сколько лет учишь английский?\n"
-        "2) Смотришь ли видео без субтитров?\n"
-        "3) Что сложнее: говорить или понимать?\n\n"
-        "Ответь 2–3 предложениями — и я скажу примерный уровень (A1–C1)."
-    )
+    await m.answer(LEVEL_TEXT)
 
-@dp.message(F.text == "💬 Вопрос ИИ")
 async def ai_mode(m: Message, state: FSMContext):
     mem_add(m.from_user.id, "user", m.text)
     await state.set_state(AIChat.question)
     await m.answer("Ок! Задай вопрос про обучение/уровень/курс/IELTS — отвечу 🙂")
 
-# ----- Intake flow -----
-@dp.message(Intake.name, F.text)
-async def intake_name(m: Message, state: FSMContext):
-    mem_add(m.from_user.id, "user", m.text)
-    await state.update_data(name=m.text.strip())
-    await state.set_state(Intake.age_group)
-    await m.answer("Кто будет заниматься?", reply_markup=age_menu())
+# одна регистрация вместо пяти `F.text == ...`: dispatcher делает один
+# проход фильтра, а нужный обработчик находится dict-лукапом за O(1)
+BUTTON_HANDLERS = {
+    "📌 Записаться на пробный урок": trial,
+    "📚 Подобрать курс": pick_course,
+    "💰 Цена и пакеты": pricing,
+    "🧪 Определить уровень": level_test,
+    "💬 Вопрос ИИ": ai_mode,
+}
 
-@dp.message(Intake.age_group, F.text)
-async def intake_age(m: Message, state: FSMContext):
-    mem_add(m.from_user.id, "user", m.text)
-    await state.update_data(age_group=m.text.strip())
-    await state.set_state(Intake.level)
-    await m.answer("Какой сейчас уровень? (если не знаешь — напиши «не знаю»)")
+@dp.message(F.text.in_(BUTTON_HANDLERS.keys()))
+async def menu_button(m: Message, state: FSMContext):
+    await BUTTON_HANDLERS[m.text](m, state)
 
-@dp.message(Intake.level, F.text)
-async def intake_level(m: Message, state: FSMContext):
-    mem_add(m.from_user.id, "user", m.text)
-    await state.update_data(level=m.text.strip())
-    await state.set_state(Intake.goal)
-    await m.answer("Какая цель? (разговорный/IELTS/работа/переезд и т.д.)")
-
-@dp.message(Intake.goal, F.text)
-async def intake_goal(m: Message, state: FSMContext):
-    mem_add(m.from_user.id, "user", m.text)
-    await state.update_data(goal=m.text.strip())
-    await state.set_state(Intake.schedule)
-    await m.answer(
+# ----- Intake flow -----
+# шаги анкеты описаны таблицей: state -> (ключ данных, следующий state,
+# текст вопроса, клавиатура). Один обработчик + один dict-лукап вместо пяти
+# почти одинаковых обработчиков и их фильтров на каждый апдейт
+INTAKE_STEPS = {
+    Intake.name: (
+        "name", Intake.age_group,
+        "Кто будет заниматься?", AGE_MENU,
+    ),
+    Intake.age_group: (
+        "age_group", Intake.level,
+        "Какой сейчас уровень? (если не знаешь — напиши «не знаю»)", None,
+    ),
+    Intake.level: (
+        "level", Intake.goal,
+        "Какая цель? (разговорный/IELTS/работа/переезд и т.д.)", None,
+    ),
+    Intake.goal: (
+        "goal", Intake.schedule,
         f"Когда удобно заниматься? (дни/время) + часовой пояс.\n"
-        f"Если ты в Казахстане, обычно {TIMEZONE}."
-    )
+        f"Если ты в Казахстане, обычно {TIMEZONE}.", None,
+    ),
+    Intake.schedule: (
+        "schedule", Intake.contact,
+        "Оставь контакт для связи (ник/телефон) или напиши «без контакта».\n"
+        "⚠️ Пиши только то, что готов(а) сообщить.", None,
+    ),
+}
 
-@dp.message(Intake.schedule, F.text)
-async def intake_schedule(m: Message, state: FSMContext):
+# get_state() отдаёт строку вида "Intake:name" — готовим лукап по ней
+_INTAKE_BY_NAME = {s.state: step for s, step in INTAKE_STEPS.items()}
+
+@dp.message(StateFilter(*INTAKE_STEPS.keys()), F.text)
+async def intake_step(m: Message, state: FSMContext):
     mem_add(m.from_user.id, "user", m.text)
-    await state.update_data(schedule=m.text.strip())
-    await state.set_state(Intake.contact)
-    await m.answer(
-        "Оставь контакт для связи (ник/телефон) или напиши «без контакта».\n"
-        "⚠️ Пиши только то, что готов(а) сообщить."
-    )
+    key, next_state, question, markup = _INTAKE_BY_NAME[await state.get_state()]
+    await state.update_data({key: m.text.strip()})
+    await state.set_state(next_state)
+    await m.answer(question, reply_markup=markup)
 
 @dp.message(Intake.contact, F.text)
 async def intake_contact(m: Message, state: FSMContext):
     mem_add(m.from_user.id, "user", m.text)
 
+    # один dict и для Lead, и для текста админу — без обратного чтения полей
     data = await state.get_data()
-    lead = Lead(
-        tg_id=m.from_user.id,
-        name=data.get("name", ""),
-        age_group=data.get("age_group", ""),
-        level=data.get("level", ""),
-        goal=data.get("goal", ""),
-        schedule=data.get("schedule", ""),
-        contact=m.text.strip(),
-    )
-    upsert_lead(lead)
+    payload = {
+        "tg_id": m.from_user.id,
+        "name": data.get("name", ""),
+        "age_group": data.get("age_group", ""),
+        "level": data.get("level", ""),
+        "goal": data.get("goal", ""),
+        "schedule": data.get("schedule", ""),
+        "contact": m.text.strip(),
+    }
+    # upsert_lead теперь write-behind: O(1), без fsync на пути ответа
+    upsert_lead(Lead(**payload))
     await state.clear()
 
     await m.answer(
         "✅ Готово! Заявка сохранена.\n\n"
         "Чтобы подтвердить пробный урок — напиши 2–3 удобных времени.\n"
         "Или задай вопрос через «💬 Вопрос ИИ».",
-        reply_markup=main_menu(),
+        reply_markup=MAIN_MENU,
     )
 
     if ADMIN_ID and ADMIN_ID != 0:
-        try:
-            await bot.send_message(
-                ADMIN_ID,
-                "📥 НОВЫЙ ЛИД:\n"
-                f"tg_id: {lead.tg_id}\n"
-                f"name: {lead.name}\n"
-                f"age: {lead.age_group}\n"
-                f"level: {lead.level}\n"
-                f"goal: {lead.goal}\n"
-                f"schedule: {lead.schedule}\n"
-                f"contact: {lead.contact}"
-            )
-        except Exception:
-            logging.exception("Failed to notify admin")
+        # уведомление админа уходит фоном, не задерживая ответ пользователю
+        spawn(_notify_admin(ADMIN_TPL.format_map(payload)))
 
 # ----- AI Q&A -----
 @dp.message(AIChat.question, F.text)
 async def ai_answer(m: Message, state: FSMContext):
     user_text = m.text.strip()
     mem_add(m.from_user.id, "user", user_text)
-
-    answer = await ask_gemini(m.from_user.id, user_text)
-
-    # чуть-чуть защиты от пустого ответа
-    if not answer:
-        answer = "Я не смог(ла) сформулировать ответ. Спроси иначе или нажми «📚 Подобрать курс»."
-
-    mem_add(m.from_user.id, "assistant", answer)
-    await m.answer(answer, reply_markup=main_menu())
+    dispatch_ai(m, user_text)
 
 # ----- Admin -----
 @dp.message(Command("stats"))
@@ -307,7 +476,7 @@ async def stats(m: Message):
 async def reset_ai(m: Message):
     if m.from_user.id != ADMIN_ID:
         return
-    MEM.clear()
+    mem_clear()
     await m.answer("✅ AI memory очищена.")
 
 # ----- Fallback: если не в анкете и не в AI-режиме, отвечаем ИИ кратко -----
@@ -321,12 +490,20 @@ async def fallback(m: Message, state: FSMContext):
     user_text = (m.text or "").strip()
     mem_add(m.from_user.id, "user", user_text)
 
-    answer = await ask_gemini(m.from_user.id, user_text)
-    mem_add(m.from_user.id, "assistant", answer)
-    await m.answer(answer, reply_markup=main_menu())
+    # casefold корректнее lower() для кириллицы; короткие сообщения ключевых
+    # слов не содержат — не сканируем их вообще
+    text = user_text.casefold()
+    if len(text) >= 3:
+        hits = match_keywords(text)
+        if "price" in hits:
+            return await m.answer(PRICING_TEXT, reply_markup=MAIN_MENU)
+        if "level" in hits:
+            return await m.answer(LEVEL_TEXT, reply_markup=MAIN_MENU)
 
-# --------- Health server (для Koyeb health checks) ----------
-async def run_health_server(stop_event: asyncio.Event):
+    dispatch_ai(m, user_text)
+
+# --------- Web server (health checks + webhook) ----------
+async def run_web_server(stop_event: asyncio.Event):
     app = web.Application()
 
     async def health(_request):
@@ -335,13 +512,20 @@ async def run_health_server(stop_event: asyncio.Event):
     app.router.add_get("/", health)
     app.router.add_get("/health", health)
 
+    if PUBLIC_URL:
+        # апдейты приходят POST'ом на /webhook/<secret> в тот же aiohttp-сервер
+        SimpleRequestHandler(
+            dispatcher=dp, bot=bot, handle_in_background=False
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+
     runner = web.AppRunner(app)
     await runner.setup()
 
     port = int(os.getenv("PORT", "8000"))
     site = web.TCPSite(runner, host="0.0.0.0", port=port)
     await site.start()
-    logging.info("Health server listening on 0.0.0.0:%s", port)
+    logging.info("Web server listening on 0.0.0.0:%s", port)
 
     await stop_event.wait()
     await runner.cleanup()
@@ -349,16 +533,26 @@ async def run_health_server(stop_event: asyncio.Event):
 # --------- Main ----------
 async def main():
     init_db()
-    logging.info("Starting bot polling...")
 
     stop_event = asyncio.Event()
     try:
-        await asyncio.gather(
-            run_health_server(stop_event),
-            dp.start_polling(bot),
-        )
+        if PUBLIC_URL:
+            logging.info("Starting bot in webhook mode: %s%s", PUBLIC_URL, WEBHOOK_PATH)
+            await bot.set_webhook(f"{PUBLIC_URL}{WEBHOOK_PATH}")
+            await run_web_server(stop_event)
+        else:
+            # fallback для локальных запусков без публичного URL;
+            # вебхук с прошлого деплоя надо снять, иначе getUpdates получит 409
+            await bot.delete_webhook()
+            logging.info("Starting bot polling...")
+            await asyncio.gather(
+                run_web_server(stop_event),
+                dp.start_polling(bot),
+            )
     finally:
         stop_event.set()
+        if _http is not None and not _http.closed:
+            await _http.close()
         await bot.session.close()
 
 if __name__ == "__main__":